@@ -1,20 +1,51 @@
 import cv2
-from PIL import Image
+import numpy as np
 from transformers import BlipProcessor, BlipForConditionalGeneration
-from pythonosc import udp_client
 import torch
 import time
 import argparse
+import difflib
+import queue
+import socket
+import sys
+import threading
+
+# En-tête OSC constant pour "/harmonium/label" avec un seul argument string :
+# adresse et type tag sont terminés par \0 et alignés sur 4 octets
+OSC_LABEL_HEADER = b"/harmonium/label\0\0\0\0" + b",s\0\0"
+
+def osc_label_packet(label):
+    payload = label.encode("utf-8")
+    pad = (4 - (len(payload) + 1) % 4) % 4
+    return OSC_LABEL_HEADER + payload + b"\0" * (pad + 1)
 
 def main():
     parser = argparse.ArgumentParser(description="Video to OSC for Harmonium")
     parser.add_argument("--video", type=str, default="demo.mp4", help="Path to video file")
     parser.add_argument("--ip", type=str, default="127.0.0.1", help="OSC Server IP")
     parser.add_argument("--port", type=int, default=8080, help="OSC Server Port")
+    parser.add_argument("--batch-size", type=int, default=16, help="Frames per inference batch")
+    parser.add_argument("--quantize", action="store_true",
+                        help="Quantize the model to int8 when running on CPU (may alter captions)")
+    parser.add_argument("--change-threshold", type=float, default=0.3,
+                        help="Minimum caption change (0-1) before sending a new label")
+    parser.add_argument("--min-interval", type=float, default=1.0,
+                        help="Minimum delay in seconds between two OSC sends")
+    parser.add_argument("--compile", action="store_true",
+                        help="Compile the vision encoder with torch.compile (CUDA only)")
     args = parser.parse_args()
+    if args.batch_size < 1:
+        parser.error("--batch-size must be at least 1")
 
-    # 1. Configurer le client OSC
-    client = udp_client.SimpleUDPClient(args.ip, args.port)
+    # 1. Résoudre la cible OSC une seule fois (IPv4 ou IPv6) pour échouer tôt
+    # sur une adresse invalide plutôt qu'à chaque envoi
+    try:
+        family, _, _, _, osc_target = socket.getaddrinfo(
+            args.ip, args.port, type=socket.SOCK_DGRAM
+        )[0]
+    except socket.gaierror as e:
+        print(f"Error: Could not resolve OSC target {args.ip}:{args.port}: {e}")
+        sys.exit(1)
     print(f"OSC Client sending to {args.ip}:{args.port}")
 
     # 2. Charger le modèle AI (BLIP Image Captioning)
@@ -22,7 +53,47 @@ def main():
     model_id = "Salesforce/blip-image-captioning-base"
     processor = BlipProcessor.from_pretrained(model_id)
     model = BlipForConditionalGeneration.from_pretrained(model_id)
-    print("Model loaded.")
+
+    # Utiliser le GPU (CUDA / Apple MPS) si disponible, sinon CPU
+    if torch.cuda.is_available():
+        device = "cuda"
+    elif torch.backends.mps.is_available():
+        device = "mps"
+    else:
+        device = "cpu"
+    model = model.to(device).eval()
+    if device == "cpu" and args.quantize:
+        # Sans GPU, sur demande : quantification dynamique int8 des couches
+        # Linear (la majorité du coût d'un transformer), plus rapide sur CPU
+        # mais les descriptions générées peuvent différer du modèle fp32
+        model = torch.ao.quantization.quantize_dynamic(
+            model, {torch.nn.Linear}, dtype=torch.qint8
+        )
+    # fp16 uniquement sur GPU : sur CPU l'autocast fp16 est lent ou non supporté
+    use_fp16 = device != "cpu"
+    print(f"Model loaded on {device}.")
+
+    # Paramètres de prétraitement du processor (taille d'entrée, mean/std),
+    # appliqués directement avec OpenCV/torch pour éviter le passage par PIL
+    image_processor = processor.image_processor
+    input_size = (image_processor.size["width"], image_processor.size["height"])
+    mean = torch.tensor(image_processor.image_mean, device=device).view(1, 3, 1, 1)
+    std = torch.tensor(image_processor.image_std, device=device).view(1, 3, 1, 1)
+
+    # Compiler l'encodeur d'image (graphe statique, taille fixe) : generate()
+    # appelle model.vision_model, on remplace donc ce module par sa version compilée
+    compiled = args.compile and device == "cuda"
+    if args.compile and not compiled:
+        print(f"torch.compile skipped: not supported on {device}.")
+    if compiled:
+        print("Compiling vision encoder...")
+        model.vision_model = torch.compile(model.vision_model, mode="reduce-overhead")
+        # Pré-compiler avec la taille de batch exacte pour éviter les recompilations
+        dummy = torch.zeros(args.batch_size, 3, input_size[1], input_size[0], device=device)
+        with torch.inference_mode(), torch.autocast(
+            device_type=device, dtype=torch.float16, enabled=use_fp16
+        ):
+            model.vision_model(pixel_values=dummy)
 
     # 3. Lire la vidéo
     cap = cv2.VideoCapture(args.video)
@@ -30,42 +101,139 @@ def main():
         print(f"Error: Could not open video {args.video}")
         return
 
+    # Socket UDP OSC, réutilisé pour tous les envois
+    sock = socket.socket(family, socket.SOCK_DGRAM)
+
     frame_count = 0
     skip_frames = 30  # Analyse toutes les 30 frames
+    batch_size = args.batch_size
+    batch = []  # Frames en attente d'inférence
+    # File entre l'inférence et l'envoi OSC. Sous charge, seule la description
+    # la plus récente compte : le sender vide la file jusqu'à la dernière
+    # entrée avant chaque envoi, et publish() écrase les plus anciennes
+    pending = queue.Queue(maxsize=batch_size)
+
+    def sender():
+        last_caption = None  # Dernière description envoyée
+        last_send = 0.0
+        running = True
+        while running:
+            caption = pending.get()
+            if caption is None:
+                break
+
+            # Délai minimal entre deux envois pour éviter de surcharger le
+            # moteur audio Rust (BERT inference), sans bloquer l'inférence
+            wait = last_send + args.min_interval - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+
+            # Ne garder que la description la plus récente arrivée entre-temps
+            while True:
+                try:
+                    newer = pending.get_nowait()
+                except queue.Empty:
+                    break
+                if newer is None:
+                    running = False
+                    break
+                caption = newer
+
+            # Ne renvoyer que si la description a réellement changé :
+            # Rust relance l'inférence BERT à chaque message reçu
+            if last_caption is not None:
+                similarity = difflib.SequenceMatcher(None, last_caption, caption).ratio()
+                if 1.0 - similarity < args.change_threshold:
+                    continue
+
+            # 5. Envoyer à Rust via OSC
+            # On envoie la description générée. Rust fera le mapping sémantique.
+            try:
+                sock.sendto(osc_label_packet(caption), osc_target)
+            except OSError as e:
+                print(f"Error: Could not send OSC label: {e}")
+                continue
+            last_caption = caption
+            last_send = time.monotonic()
+
+    def publish(captions):
+        for caption in captions:
+            while True:
+                try:
+                    pending.put_nowait(caption)
+                    break
+                except queue.Full:
+                    # File pleine : la plus ancienne description est périmée
+                    try:
+                        pending.get_nowait()
+                    except queue.Empty:
+                        pass
+
+    def flush(batch):
+        count = len(batch)
+        if compiled and count < batch_size:
+            # Compléter le dernier batch pour garder la forme compilée
+            batch = batch + [batch[-1]] * (batch_size - count)
+
+        # 4. Analyser les images avec l'AI (Génération de descriptions en batch)
+        pixel_values = torch.from_numpy(np.stack(batch)).to(device, non_blocking=True)
+        pixel_values = pixel_values.permute(0, 3, 1, 2).float().div_(255).sub_(mean).div_(std)
+
+        # Générer les captions pour tout le batch en un seul appel
+        with torch.inference_mode(), torch.autocast(
+            device_type=device, dtype=torch.float16, enabled=use_fp16
+        ):
+            out = model.generate(pixel_values=pixel_values, max_new_tokens=20)
+        captions = processor.batch_decode(out[:count], skip_special_tokens=True)
+
+        for caption in captions:
+            print(f"Generated: {caption}")
+        publish(captions)
+
+    sender_thread = threading.Thread(target=sender, daemon=True)
+    sender_thread.start()
 
     print("Starting analysis...")
 
     while cap.isOpened():
-        ret, frame = cap.read()
-        if not ret:
+        # grab() avance sans décoder l'image : on ne paie le décodage complet
+        # (retrieve) que pour la frame analysée. Plus fiable que de seek via
+        # CAP_PROP_POS_FRAMES, qui est lent sur les codecs à GOP long.
+        if not cap.grab():
             break
 
         frame_count += 1
         if frame_count % skip_frames != 0:
             continue
 
-        # Convertir BGR (OpenCV) vers RGB (PIL)
-        image = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-        pil_image = Image.fromarray(image)
-
-        # 4. Analyser l'image avec l'AI (Génération de description)
-        inputs = processor(pil_image, return_tensors="pt")
-        
-        # Générer la caption
-        out = model.generate(**inputs, max_new_tokens=20)
-        caption = processor.decode(out[0], skip_special_tokens=True)
+        ret, frame = cap.retrieve()
+        if not ret:
+            break
 
-        print(f"Generated: {caption}")
+        # Réduire d'abord à la taille du modèle, puis BGR (OpenCV) vers RGB
+        # sur la petite image seulement
+        small = cv2.resize(frame, input_size, interpolation=cv2.INTER_AREA)
+        batch.append(np.ascontiguousarray(small[:, :, ::-1]))
 
-        # 5. Envoyer à Rust via OSC
-        # On envoie la description générée. Rust fera le mapping sémantique.
-        client.send_message("/harmonium/label", caption)
+        if len(batch) >= batch_size:
+            flush(batch)
+            batch = []
 
-        # Petit délai pour ne pas spammer si la vidéo est lue très vite
-        # Augmenté à 1.0s pour éviter de surcharger le moteur audio Rust (BERT inference)
-        time.sleep(1.0)
+    # Vider le dernier batch partiel en fin de vidéo
+    if batch:
+        flush(batch)
 
     cap.release()
+
+    # Laisser partir le dernier label avant de quitter
+    while sender_thread.is_alive():
+        try:
+            pending.put(None, timeout=1.0)
+            break
+        except queue.Full:
+            pass
+    sender_thread.join()
+    sock.close()
     print("Done.")
 
 if __name__ == "__main__":